@@ -4,15 +4,20 @@ from discord import app_commands
 import os
 from dotenv import load_dotenv
 import json
+import orjson
 import time
 import random
 import io
 import contextlib
+import mmap
 import textwrap
-import aiofiles
-import threading
-from datetime import datetime, timedelta, timezone
-import uuid
+import traceback
+import asyncio
+import heapq
+import secrets
+import tempfile
+from collections import OrderedDict
+from dataclasses import dataclass
 import firebase_admin
 from firebase_admin import credentials, firestore, exceptions
 from keep_alive import keep_alive
@@ -31,6 +36,10 @@ CONFIG_FILE = 'config.json'
 USER_CACHE_FILE = 'user_cache.json'
 GUILD_CACHE_FILE = 'guild_cache.json'
 LICENSE_FILE = 'licenses.json'
+LEVELS_LOG = 'levels.log'  # Append-only log of level changes since the last snapshot
+LEVELS_LOG_ROTATED = 'levels.log.1'  # Log being folded into a snapshot by a background compaction
+UMASK = os.umask(0)  # Read once at startup; the only way to read the umask is to set it
+os.umask(UMASK)
 # ---------------------------
 
 # --- Configuration and In-Memory Storage ---
@@ -38,14 +47,48 @@ LEVELS_DB = {}
 ACTIVE_GIVEWAYS = {}
 GIVEAWAY_MESSAGES = {}
 CONFIG_DB = {}
-USER_CACHE = {}
+USER_CACHE = OrderedDict()  # Least recently used names first; bounded by USER_CACHE_MAX_SIZE
 GUILD_CACHE = {}  # Cache for guild names: {guild_id: guild_name}
-LICENSE_DB = {}
+LICENSE_DB = OrderedDict()  # Recently used license keys, least recently used first; bounded by LICENSE_CACHE_MAX_SIZE
 BOT_OWNER_ID = 1436238952389410837
-USER_CACHE_LOCK = threading.Lock()
 BOT_START_TIME = time.time()
+LEVELS_LOG_HANDLE = None
+LEVELS_LOG_COUNT = 0  # Number of entries appended to LEVELS_LOG since the last compaction
+LEVELS_COMPACT_EVERY = 1000
+XP_COOLDOWN = 60  # Seconds after earning XP before a user's messages earn XP again
+LEVELS_COMPACTION = None  # Background task writing the latest levels snapshot
+USER_CACHE_DIRTY = False  # Set when USER_CACHE has changes that flush_user_cache has not written yet
+USER_CACHE_MAX_SIZE = 50_000
+DIRTY_DATA = set()  # Data types passed to save_data() that flush_data has not written yet
+KEEP_ALIVE_RUNNER = None
+EVAL_CACHE_MAX_SIZE = 32
+EVAL_OUTPUT_LIMIT = 1024 * 1024  # Characters of stdout an /eval snippet may print
+PENDING_GUILD_CONFIGS = {}  # Guild configs queued for Firestore that flush_guild_configs has not written yet
+FIRESTORE_BATCH_LIMIT = 500  # Firestore rejects batches with more writes than this
+PREMIUM_CACHE = {}  # {guild_id: (valid_until, is_guild_premium result)}
+PREMIUM_CACHE_TTL = 60
+LICENSE_CACHE_MAX_SIZE = 10_000
+AUTOMOD_RULE_CACHE = {}  # {guild_id: (valid_until, {rule_name: AutoModRule})}
+AUTOMOD_RULE_CACHE_TTL = 60
+FIRESTORE_WATCHES = []  # Snapshot listeners started by watch_firestore()
+BACKGROUND_WRITES = set()  # Thread writes started by run_background_write() that have not finished yet
+GUILD_CONFIG_WRITE_LOCK = asyncio.Lock()  # Held while guild configs are committed to Firestore, so the newest write lands last
+ACTIVITY_TYPES = {  # /set_status activity_type choice values
+    0: discord.ActivityType.playing,
+    3: discord.ActivityType.watching,
+    2: discord.ActivityType.listening,
+    5: discord.ActivityType.competing
+}
 # ----------------------------------------------------------------------
 
+
+@dataclass(slots=True)
+class UserLevel:
+    """A single LEVELS_DB entry. Slots keep it at a quarter of the size of an equivalent dict."""
+    xp: int = 0
+    level: int = 0
+
+
 # ==============================================================================
 # FIREBASE PERSISTENCE FUNCTIONS
 # ==============================================================================
@@ -84,60 +127,94 @@ def initialize_firestore():
     print("--- Firebase Initialization Check Complete ---")
 
 
-async def load_licenses_from_firestore():
-    """Loads all licenses from Firestore into the in-memory LICENSE_DB."""
-    global LICENSE_DB
-    if DB is None:
-        print("WARNING: Cannot load licenses from Firestore. DB not initialized.")
-        return
-    try:
-        licenses_ref = DB.collection('licenses')
-        docs = licenses_ref.stream()
-        count = 0
-        for doc in docs:
-            LICENSE_DB[doc.id] = doc.to_dict()
-            count += 1
-        print(f"Loaded {count} license keys from Firestore.")
-    except Exception as e:
-        print(f"ERROR: Failed to load licenses from Firestore: {e}")
-
-
 # ==============================================================================
-# FIX #1: Load guild configs (premium status) from Firestore on startup.
+# FIX #1: Keep guild configs (premium status) in step with Firestore.
 # This is the core fix for premium status being lost after a bot restart.
 # Hugging Face Spaces does not persist local files between restarts, so
 # CONFIG_DB must be populated from Firestore, not just from config.json.
+# The listener's first snapshot delivers the whole collection, and
+# later snapshots carry only the documents that changed, including changes
+# made by other instances or by hand in the console.
 # ==============================================================================
 
-async def load_guild_configs_from_firestore():
-    """Loads all guild configs (including premium status) from Firestore into CONFIG_DB."""
-    global CONFIG_DB
+def watch_firestore(loop):
+    """Starts a listener that mirrors the guild_configs collection into CONFIG_DB."""
     if DB is None:
-        print("WARNING: Cannot load guild configs from Firestore. DB not initialized.")
+        print("WARNING: Cannot watch Firestore. DB not initialized.")
         return
+
+    def on_snapshot(docs, changes, read_time):
+        # Called on a Firestore worker thread; convert the documents here and let the event
+        # loop apply them so CONFIG_DB is only ever mutated from one thread.
+        updates = [
+            (change.document.id, None if change.type.name == 'REMOVED' else change.document.to_dict())
+            for change in changes
+        ]
+        loop.call_soon_threadsafe(apply_guild_config_changes, updates)
+
     try:
-        docs = DB.collection('guild_configs').stream()
-        count = 0
-        for doc in docs:
-            # Firestore document IDs are the guild_id strings
-            CONFIG_DB[doc.id] = doc.to_dict()
-            count += 1
-        print(f"Loaded {count} guild configs from Firestore.")
+        FIRESTORE_WATCHES.append(DB.collection('guild_configs').on_snapshot(on_snapshot))
     except Exception as e:
-        print(f"ERROR: Failed to load guild configs from Firestore: {e}")
+        print(f"ERROR: Failed to start Firestore listener: {e}")
+
+
+def apply_guild_config_changes(updates):
+    """Applies guild config documents added, changed or removed in Firestore to CONFIG_DB."""
+    for doc_id, config_data in updates:
+        # Firestore document IDs are the guild_id strings; CONFIG_DB is keyed by the int ID.
+        if not doc_id.isdigit():
+            continue
+        guild_id = int(doc_id)
+        if guild_id in PENDING_GUILD_CONFIGS:
+            # A local edit has not been written yet and is newer than this snapshot.
+            continue
+        if config_data is None:
+            CONFIG_DB.pop(guild_id, None)
+        else:
+            CONFIG_DB[guild_id] = config_data
+        PREMIUM_CACHE.pop(guild_id, None)
+    print(f"Synced {len(updates)} guild configs from Firestore.")
 
 
-def save_guild_config_to_firestore(guild_id_str: str, config_data: dict):
-    """Saves a guild's config (including premium status) to Firestore."""
+def save_guild_config_to_firestore(guild_id: int, config_data: dict):
+    """Queues a guild's config (including premium status); flush_guild_configs writes it to Firestore."""
     if DB is None:
         print("WARNING: Cannot save guild config. DB not initialized.")
         return False
-    try:
-        DB.collection('guild_configs').document(guild_id_str).set(config_data)
-        return True
-    except Exception as e:
-        print(f"ERROR: Failed to save guild config {guild_id_str} to Firestore: {e}")
-        return False
+    PENDING_GUILD_CONFIGS[guild_id] = config_data
+    return True
+
+
+def save_guild_configs_now(configs: dict):
+    """Writes guild configs to Firestore in batched commits and returns the ones that failed."""
+    items = list(configs.items())
+    for start in range(0, len(items), FIRESTORE_BATCH_LIMIT):
+        batch = DB.batch()
+        for guild_id, config_data in items[start:start + FIRESTORE_BATCH_LIMIT]:
+            batch.set(DB.collection('guild_configs').document(str(guild_id)), config_data)
+        try:
+            batch.commit()
+        except Exception as e:
+            print(f"ERROR: Failed to save {len(items) - start} guild configs to Firestore: {e}")
+            return dict(items[start:])
+    return {}
+
+
+@tasks.loop(seconds=2)
+async def flush_guild_configs():
+    """Writes the guild configs queued since the last run to Firestore, off the event loop."""
+    if not PENDING_GUILD_CONFIGS:
+        return
+    async with GUILD_CONFIG_WRITE_LOCK:
+        # Copy each config so commands can keep editing CONFIG_DB while the batch is serialized.
+        configs = {guild_id: dict(config_data) for guild_id, config_data in PENDING_GUILD_CONFIGS.items()}
+        PENDING_GUILD_CONFIGS.clear()
+        failed = await run_background_write(save_guild_configs_now, configs)
+        for guild_id in failed:
+            # Retry with the current config rather than the copy that failed, which may
+            # be older than a write made since (e.g. by /license_activate).
+            if guild_id in CONFIG_DB:
+                PENDING_GUILD_CONFIGS.setdefault(guild_id, CONFIG_DB[guild_id])
 
 
 def save_license_to_firestore(license_key: str, license_data: dict):
@@ -154,6 +231,38 @@ def save_license_to_firestore(license_key: str, license_data: dict):
         return False
 
 
+def save_license_activation_to_firestore(license_key: str, license_data: dict, guild_id: int, premium_info: dict):
+    """Saves a used license key and the premium status it grants a guild in a single transaction.
+
+    Only the guild config's 'premium' field is written; its other fields are left as they are.
+
+    Returns 'activated', 'used' if the key was used or deleted elsewhere since it was read, or 'failed'.
+    """
+    if DB is None:
+        print("WARNING: Cannot save license activation. DB not initialized.")
+        return 'failed'
+    try:
+        return commit_license_activation(
+            DB.transaction(),
+            DB.collection('licenses').document(license_key), license_data,
+            DB.collection('guild_configs').document(str(guild_id)), premium_info
+        )
+    except Exception as e:
+        print(f"ERROR: Failed to save activation of license {license_key} for guild {guild_id} to Firestore: {e}")
+        return 'failed'
+
+
+@firestore.transactional
+def commit_license_activation(transaction, license_ref, license_data: dict, config_ref, premium_info: dict):
+    """Marks a license as used unless Firestore already has it as used; retried by Firestore on contention."""
+    stored = license_ref.get(transaction=transaction).to_dict()
+    if not stored or stored.get('is_used'):
+        return 'used'
+    transaction.set(license_ref, license_data)
+    transaction.set(config_ref, {'premium': premium_info}, merge=['premium'])
+    return 'activated'
+
+
 def get_license_from_firestore(license_key: str):
     """Retrieves a single license key's data from Firestore."""
     if DB is None:
@@ -170,6 +279,27 @@ def get_license_from_firestore(license_key: str):
         return None
 
 
+def cache_license(license_key: str, license_data: dict):
+    """Stores a license as the most recently used LICENSE_DB entry, evicting the oldest past LICENSE_CACHE_MAX_SIZE."""
+    LICENSE_DB[license_key] = license_data
+    LICENSE_DB.move_to_end(license_key)
+    while len(LICENSE_DB) > LICENSE_CACHE_MAX_SIZE:
+        LICENSE_DB.popitem(last=False)
+
+
+async def get_license(license_key: str):
+    """Returns a license from LICENSE_DB, fetching it from Firestore on a miss. Returns None if it does not exist."""
+    license_data = LICENSE_DB.get(license_key)
+    if license_data is not None:
+        LICENSE_DB.move_to_end(license_key)
+        return license_data
+    # Misses are not cached: the dashboard can create a key at any time.
+    license_data = await asyncio.to_thread(get_license_from_firestore, license_key)
+    if license_data is not None:
+        cache_license(license_key, license_data)
+    return license_data
+
+
 def delete_license_from_firestore(license_key: str):
     """Deletes a license key document from Firestore."""
     if DB is None:
@@ -177,8 +307,6 @@ def delete_license_from_firestore(license_key: str):
         return False
     try:
         DB.collection('licenses').document(license_key).delete()
-        if license_key in LICENSE_DB:
-            del LICENSE_DB[license_key]
         return True
     except Exception as e:
         print(f"ERROR: Failed to delete license {license_key} from Firestore: {e}")
@@ -189,58 +317,116 @@ def delete_license_from_firestore(license_key: str):
 # JSON File Persistence Functions
 # ==============================================================================
 
-def load_data():
-    """Loads all data (LEVELS_DB, ACTIVE_GIVEWAYS, CONFIG_DB, USER_CACHE, GUILD_CACHE) from JSON files."""
+def int_keyed(data):
+    """Returns a copy of a loaded JSON object with its string keys converted back to int IDs."""
+    return dict(zip(map(int, data), data.values()))
+
+
+def levels_from_json(data):
+    """Converts a loaded levels object straight to {int user ID: UserLevel} in one pass."""
+    return {int(user_id): UserLevel(**entry) for user_id, entry in data.items()}
+
+
+def read_json_file(file_path, convert=int_keyed):
+    """Reads one JSON data file via mmap and passes the parsed object through `convert`.
+
+    Returns None if the file does not exist, or {} if it could not be loaded.
+    """
+    try:
+        # Parse straight out of the page cache instead of copying the file into a bytes object first.
+        with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                data = orjson.loads(view)
+        return convert(data)
+    except FileNotFoundError:
+        return None
+    except (OSError, TypeError, ValueError) as e:
+        # ValueError covers malformed JSON (orjson.JSONDecodeError), empty files that cannot be
+        # mapped, and keys that are not numeric IDs; TypeError covers malformed level entries.
+        print(f"Error loading {file_path}: {e}")
+        return {}
+
+
+async def load_data():
+    """Loads all data (LEVELS_DB, ACTIVE_GIVEWAYS, CONFIG_DB, USER_CACHE, GUILD_CACHE) from JSON files.
+
+    The files are independent, so they are read and parsed concurrently in worker threads.
+    """
     global LEVELS_DB, ACTIVE_GIVEWAYS, CONFIG_DB, USER_CACHE, GUILD_CACHE
 
-    if os.path.exists(LEVELS_FILE):
-        try:
-            with open(LEVELS_FILE, 'r') as f:
-                LEVELS_DB = {int(k): v for k, v in json.load(f).items()}
-            print(f"Loaded {len(LEVELS_DB)} user levels.")
-        except Exception as e:
-            print(f"Error loading {LEVELS_FILE}: {e}")
-            LEVELS_DB = {}
+    levels, giveaways, config, user_cache, guild_cache = await asyncio.gather(
+        asyncio.to_thread(read_json_file, LEVELS_FILE, levels_from_json),
+        asyncio.to_thread(read_json_file, GIVEAWAYS_FILE),
+        asyncio.to_thread(read_json_file, CONFIG_FILE),
+        asyncio.to_thread(read_json_file, USER_CACHE_FILE),
+        asyncio.to_thread(read_json_file, GUILD_CACHE_FILE),
+    )
 
-    if os.path.exists(GIVEAWAYS_FILE):
-        try:
-            with open(GIVEAWAYS_FILE, 'r') as f:
-                ACTIVE_GIVEWAYS = {int(k): v for k, v in json.load(f).items()}
-            print(f"Loaded {len(ACTIVE_GIVEWAYS)} active giveaways.")
-        except Exception as e:
-            print(f"Error loading {GIVEAWAYS_FILE}: {e}")
-            ACTIVE_GIVEWAYS = {}
+    if levels is not None:
+        LEVELS_DB = levels
+        print(f"Loaded {len(LEVELS_DB)} user levels.")
 
-    if os.path.exists(CONFIG_FILE):
-        try:
-            with open(CONFIG_FILE, 'r') as f:
-                CONFIG_DB = {int(k): v for k, v in json.load(f).items()}
-            print(f"Loaded config data.")
-        except Exception as e:
-            print(f"Error loading {CONFIG_FILE}: {e}")
-            CONFIG_DB = {}
+    replay_levels_log()
 
-    if os.path.exists(USER_CACHE_FILE):
-        try:
-            with open(USER_CACHE_FILE, 'r') as f:
-                USER_CACHE = json.load(f)
-            print(f"Loaded {len(USER_CACHE)} user names from cache.")
-        except Exception as e:
-            print(f"Error loading {USER_CACHE_FILE}: {e}")
-            USER_CACHE = {}
+    if giveaways is not None:
+        ACTIVE_GIVEWAYS = giveaways
+        print(f"Loaded {len(ACTIVE_GIVEWAYS)} active giveaways.")
 
-    if os.path.exists(GUILD_CACHE_FILE):
-        try:
-            with open(GUILD_CACHE_FILE, 'r') as f:
-                GUILD_CACHE = {int(k): v for k, v in json.load(f).items()}
-            print(f"Loaded {len(GUILD_CACHE)} guild names from cache.")
-        except Exception as e:
-            print(f"Error loading {GUILD_CACHE_FILE}: {e}")
-            GUILD_CACHE = {}
+    if config is not None:
+        CONFIG_DB = config
+        print(f"Loaded config data.")
+
+    if user_cache is not None:
+        USER_CACHE = OrderedDict(user_cache)
+        trim_user_cache()
+        print(f"Loaded {len(USER_CACHE)} user names from cache.")
+
+    if guild_cache is not None:
+        GUILD_CACHE = guild_cache
+        print(f"Loaded {len(GUILD_CACHE)} guild names from cache.")
+
+
+def write_file_atomic(file_path, payload):
+    """Writes payload to a temp file and renames it over file_path, so readers never see a partial file."""
+    # The temp file is created 0600; give the result the permissions the file had, or open()'s defaults.
+    try:
+        mode = os.stat(file_path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o666 & ~UMASK
+    # A unique temp file per call, so two writes of the same file cannot interleave in one temp file.
+    f = tempfile.NamedTemporaryFile(
+        'wb', dir=os.path.dirname(file_path) or '.', prefix=f"{os.path.basename(file_path)}.", suffix='.tmp', delete=False
+    )
+    try:
+        with f:
+            f.write(payload)
+        os.chmod(f.name, mode)
+        os.replace(f.name, file_path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(f.name)
+        raise
+
+
+def run_background_write(func, *args):
+    """Runs a blocking write (a data file or a Firestore commit) in a worker thread and returns an awaitable for it.
+
+    Cancelling the awaiting task does not stop the thread, so close() waits on BACKGROUND_WRITES
+    before writing the same files itself.
+    """
+    write = asyncio.create_task(asyncio.to_thread(func, *args))
+    BACKGROUND_WRITES.add(write)
+    write.add_done_callback(BACKGROUND_WRITES.discard)
+    return asyncio.shield(write)
 
 
 def save_data(data_type):
-    """Saves the specified data to its corresponding file."""
+    """Marks the specified data as changed; flush_data writes it to its file within a few seconds."""
+    DIRTY_DATA.add(data_type)
+
+
+def save_data_now(data_type):
+    """Saves the specified data to its corresponding file immediately."""
     if data_type == 'config':
         file_path = CONFIG_FILE
         data_to_save = CONFIG_DB
@@ -261,24 +447,131 @@ def save_data(data_type):
         return
 
     try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data_to_save, f, indent=4)
+        write_file_atomic(file_path, orjson.dumps(data_to_save, option=orjson.OPT_NON_STR_KEYS))
         print(f"INFO: Successfully saved {data_type} data to {file_path}")
     except Exception as e:
         print(f"FATAL ERROR: Failed to save {data_type} data. Error: {e}")
 
 
+@tasks.loop(seconds=5)
+async def flush_data():
+    """Writes each data type marked by save_data() since the last run, off the event loop."""
+    while DIRTY_DATA:
+        await run_background_write(save_data_now, DIRTY_DATA.pop())
+
+
+def replay_levels_log():
+    """Applies level changes logged after the last snapshot, oldest log first."""
+    global LEVELS_LOG_COUNT
+    replayed = 0
+    for log_path in (LEVELS_LOG_ROTATED, LEVELS_LOG):
+        try:
+            with open(log_path, 'r+b') as f:
+                valid_end = 0  # Byte offset just past the last complete entry
+                for line in f:
+                    try:
+                        # A line without its newline was never fully appended, even if it parses.
+                        entry = orjson.loads(line) if line.endswith(b'\n') else None
+                    except orjson.JSONDecodeError:
+                        entry = None
+                    if entry is None:
+                        # A torn final line from a crash mid-append. Cut it off, or the next append
+                        # would be glued onto it and lost along with it on the following replay.
+                        print(f"WARNING: Dropping truncated entry at the end of {log_path}.")
+                        f.truncate(valid_end)
+                        break
+                    LEVELS_DB[int(entry['k'])] = UserLevel(**entry['v'])
+                    replayed += 1
+                    valid_end += len(line)
+        except FileNotFoundError:
+            continue
+        except (OSError, KeyError, TypeError, ValueError) as e:
+            print(f"Error replaying {log_path}: {e}")
+    LEVELS_LOG_COUNT = replayed
+    if replayed:
+        print(f"Replayed {replayed} level changes from {LEVELS_LOG}.")
+
+
+def append_levels_delta(user_id, entry):
+    """Appends a single user's level entry to LEVELS_LOG, compacting the log when it grows too long."""
+    global LEVELS_LOG_HANDLE, LEVELS_LOG_COUNT, LEVELS_COMPACTION
+    try:
+        if LEVELS_LOG_HANDLE is None:
+            LEVELS_LOG_HANDLE = open(LEVELS_LOG, 'ab')
+        LEVELS_LOG_HANDLE.write(orjson.dumps({'k': user_id, 'v': entry}) + b'\n')
+        LEVELS_LOG_HANDLE.flush()
+    except Exception as e:
+        print(f"ERROR: Failed to append to {LEVELS_LOG}: {e}")
+        return
+
+    LEVELS_LOG_COUNT += 1
+    if LEVELS_LOG_COUNT >= LEVELS_COMPACT_EVERY and (LEVELS_COMPACTION is None or LEVELS_COMPACTION.done()):
+        payload = rotate_levels_log()
+        LEVELS_COMPACTION = asyncio.create_task(asyncio.to_thread(write_levels_snapshot, payload))
+
+
+def rotate_levels_log():
+    """Encodes a LEVELS_DB snapshot and moves the log it covers aside so new changes go to a fresh log."""
+    global LEVELS_LOG_HANDLE, LEVELS_LOG_COUNT
+    payload = orjson.dumps(LEVELS_DB, option=orjson.OPT_NON_STR_KEYS)
+    # A rotated log left by a failed snapshot write must survive until a snapshot lands. In that
+    # case the current log stays in place too; replaying it over the newer snapshot is harmless.
+    if not os.path.exists(LEVELS_LOG_ROTATED):
+        if LEVELS_LOG_HANDLE is not None:
+            LEVELS_LOG_HANDLE.close()
+            LEVELS_LOG_HANDLE = None
+        try:
+            os.replace(LEVELS_LOG, LEVELS_LOG_ROTATED)
+        except FileNotFoundError:
+            pass
+    LEVELS_LOG_COUNT = 0
+    return payload
+
+
+def write_levels_snapshot(payload):
+    """Writes a snapshot from rotate_levels_log() and deletes the rotated log it supersedes."""
+    try:
+        write_file_atomic(LEVELS_FILE, payload)
+        os.remove(LEVELS_LOG_ROTATED)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"FATAL ERROR: Failed to compact levels data. Error: {e}")
+
+
+def compact_levels():
+    """Writes a full LEVELS_DB snapshot and discards the log entries it covers."""
+    write_levels_snapshot(rotate_levels_log())
+
+
 async def save_user_cache():
-    """Saves the USER_CACHE dictionary to a JSON file asynchronously."""
-    with USER_CACHE_LOCK:
-        cache_copy = USER_CACHE.copy()
+    """Saves the USER_CACHE dictionary to a JSON file from a worker thread."""
     try:
-        async with aiofiles.open(USER_CACHE_FILE, 'w') as f:
-            await f.write(json.dumps(cache_copy, indent=4))
+        # Encoding happens on the event loop, which is the only writer of USER_CACHE,
+        # so no lock is needed; only the file write is handed to the thread. orjson walks
+        # the underlying dict storage, so convert first to keep the recency order on disk.
+        payload = orjson.dumps(dict(USER_CACHE), option=orjson.OPT_NON_STR_KEYS)
+        await run_background_write(write_file_atomic, USER_CACHE_FILE, payload)
     except Exception as e:
         print(f"Error saving user cache: {e}")
 
 
+def trim_user_cache():
+    """Evicts the least recently used names until USER_CACHE is within USER_CACHE_MAX_SIZE."""
+    while len(USER_CACHE) > USER_CACHE_MAX_SIZE:
+        USER_CACHE.popitem(last=False)
+
+
+@tasks.loop(seconds=2)
+async def flush_user_cache():
+    """Writes USER_CACHE to disk at most once per interval, and only when it has changed."""
+    global USER_CACHE_DIRTY
+    if not USER_CACHE_DIRTY:
+        return
+    USER_CACHE_DIRTY = False
+    await save_user_cache()
+
+
 # ==============================================================================
 # Helper Functions
 # ==============================================================================
@@ -302,64 +595,60 @@ def format_uptime(seconds):
 
 
 def is_guild_premium(guild_id: int):
-    """Checks if a guild has active, non-expired premium status."""
-    guild_config = CONFIG_DB.get(str(guild_id), {})
+    """Checks if a guild has active, non-expired premium status.
+
+    Returns (is_premium, expires_ts). expires_ts is the configured expiry even when premium is
+    inactive or expired, or None if the guild has no valid expiry.
+
+    Results are cached for up to PREMIUM_CACHE_TTL seconds and never past the premium expiry, so
+    an expiring subscription is noticed on time. Code that changes a guild's premium config must
+    drop its PREMIUM_CACHE entry.
+    """
+    now = time.time()
+    cached = PREMIUM_CACHE.get(guild_id)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+
+    result = check_guild_premium(guild_id, now)
+    expires_ts = result[1]
+    valid_until = now + PREMIUM_CACHE_TTL
+    if result[0] and expires_ts != "LIFETIME":
+        valid_until = min(valid_until, expires_ts)
+    PREMIUM_CACHE[guild_id] = (valid_until, result)
+    return result
+
+
+def check_guild_premium(guild_id: int, now: float):
+    """Reads a guild's premium status from CONFIG_DB without going through PREMIUM_CACHE."""
+    guild_config = CONFIG_DB.get(guild_id, {})
     premium_info = guild_config.get('premium', {})
 
-    if not premium_info or not premium_info.get('active', False):
+    if not premium_info:
         return False, None
 
     expires_ts = premium_info.get('expires_at')
 
-    if expires_ts == "LIFETIME":
-        return True, "LIFETIME"
-
-    try:
-        expires_ts = float(expires_ts)
-        if expires_ts > time.time():
-            return True, expires_ts
-        else:
-            return False, expires_ts
-    except (TypeError, ValueError):
-        return False, None
-
-
-async def update_user_cache(bot, user_id: int):
-    """Fetches a user and updates the in-memory and file cache."""
-    global USER_CACHE
-    user_id_str = str(user_id)
+    if expires_ts != "LIFETIME":
+        try:
+            expires_ts = float(expires_ts)
+        except (TypeError, ValueError):
+            return False, None
 
-    if user_id_str in USER_CACHE:
-        return
-
-    try:
-        user = bot.get_user(user_id)
-        if user is None:
-            user = await bot.fetch_user(user_id)
-        username = user.global_name if user.global_name else user.name
-        with USER_CACHE_LOCK:
-            USER_CACHE[user_id_str] = username
-        await save_user_cache()
-    except discord.NotFound:
-        with USER_CACHE_LOCK:
-            USER_CACHE[user_id_str] = f"Unknown User ({user_id_str})"
-        await save_user_cache()
-        print(f"Could not fetch user {user_id}: User Not Found.")
-    except Exception as e:
-        with USER_CACHE_LOCK:
-            USER_CACHE[user_id_str] = f"Unknown User ({user_id_str})"
-        await save_user_cache()
-        print(f"Could not fetch user {user_id}: {e}")
+    is_active = premium_info.get('active', False) and (expires_ts == "LIFETIME" or expires_ts > now)
+    return bool(is_active), expires_ts
 
 
 async def get_automod_rule(guild: discord.Guild, rule_name: str) -> discord.AutoModRule | None:
-    """Retrieves an existing AutoMod rule by name, if it exists."""
+    """Retrieves an existing AutoMod rule by name, if it exists.
+
+    A guild's rules are cached for AUTOMOD_RULE_CACHE_TTL seconds; /automod_setup and rule
+    create/update/delete events drop the guild's entry so changes show up straight away.
+    """
+    cached = AUTOMOD_RULE_CACHE.get(guild.id)
+    if cached is not None and cached[0] > time.time():
+        return cached[1].get(rule_name)
     try:
         rules = await guild.fetch_automod_rules()
-        for rule in rules:
-            if rule.name == rule_name:
-                return rule
-        return None
     except discord.Forbidden:
         print(f"ERROR: Bot lacks 'Manage Guild' permission to fetch AutoMod rules in {guild.name}.")
         return None
@@ -367,6 +656,12 @@ async def get_automod_rule(guild: discord.Guild, rule_name: str) -> discord.Auto
         print(f"ERROR: Failed to fetch AutoMod rules: {e}")
         return None
 
+    rules_by_name = {}
+    for rule in rules:
+        rules_by_name.setdefault(rule.name, rule)
+    AUTOMOD_RULE_CACHE[guild.id] = (time.time() + AUTOMOD_RULE_CACHE_TTL, rules_by_name)
+    return rules_by_name.get(rule_name)
+
 
 # ==============================================================================
 # Bot Setup
@@ -380,21 +675,35 @@ bot = commands.Bot(command_prefix='!', intents=intents)
 
 async def setup_hook():
     """Load Cogs, ensure persistence files exist, and then sync commands."""
-    print("Loading existing data from JSON files...")
-    load_data()
+    global KEEP_ALIVE_RUNNER
+    try:
+        KEEP_ALIVE_RUNNER = await keep_alive()
+    except OSError as e:
+        print(f"ERROR: Could not start the keep-alive server: {e}")
 
-    if not os.path.exists(LEVELS_FILE):
-        save_data('levels')
-        print(f"Created initial empty {LEVELS_FILE}.")
-    if not os.path.exists(GIVEAWAYS_FILE):
-        save_data('giveaways')
-        print(f"Created initial empty {GIVEAWAYS_FILE}.")
-    if not os.path.exists(CONFIG_FILE):
-        save_data('config')
-        print(f"Created initial empty {CONFIG_FILE}.")
-    if not os.path.exists(USER_CACHE_FILE):
-        await save_user_cache()
-        print(f"Created initial empty {USER_CACHE_FILE}.")
+    # Connecting to Firestore blocks on credential parsing and client setup, so it runs in a
+    # worker thread alongside the local file loads.
+    print("Loading existing data from JSON files...")
+    await asyncio.gather(asyncio.to_thread(initialize_firestore), load_data())
+    watch_firestore(asyncio.get_running_loop())
+
+    # Create whichever data files are missing, listing the directory once and writing them concurrently.
+    present = {entry.name for entry in os.scandir()}
+    missing = [
+        (file_path, data_type)
+        for file_path, data_type in ((LEVELS_FILE, 'levels'), (GIVEAWAYS_FILE, 'giveaways'), (CONFIG_FILE, 'config'))
+        if file_path not in present
+    ]
+    writes = [asyncio.to_thread(save_data_now, data_type) for _, data_type in missing]
+    if USER_CACHE_FILE not in present:
+        missing.append((USER_CACHE_FILE, 'user_cache'))
+        writes.append(save_user_cache())
+    await asyncio.gather(*writes)
+    for file_path, _ in missing:
+        print(f"Created initial empty {file_path}.")
+    flush_user_cache.start()
+    flush_data.start()
+    flush_guild_configs.start()
 
     print("Loading Cogs...")
     try:
@@ -417,22 +726,56 @@ async def setup_hook():
 bot.setup_hook = setup_hook
 
 
+async def close():
+    """Persist pending data and stop the keep-alive server before the bot disconnects."""
+    flush_data.cancel()
+    flush_user_cache.cancel()
+    flush_guild_configs.cancel()
+    if BACKGROUND_WRITES:
+        await asyncio.gather(*BACKGROUND_WRITES, return_exceptions=True)
+    while DIRTY_DATA:
+        save_data_now(DIRTY_DATA.pop())
+    if LEVELS_COMPACTION is not None:
+        await LEVELS_COMPACTION
+    if LEVELS_LOG_COUNT:
+        compact_levels()
+    if USER_CACHE_DIRTY:
+        await save_user_cache()
+    if PENDING_GUILD_CONFIGS:
+        save_guild_configs_now(PENDING_GUILD_CONFIGS)
+    for watch in FIRESTORE_WATCHES:
+        watch.unsubscribe()
+    if KEEP_ALIVE_RUNNER is not None:
+        await KEEP_ALIVE_RUNNER.cleanup()
+    await commands.Bot.close(bot)
+
+
+bot.close = close
+
+
 @bot.event
 async def on_ready():
-    """Loads licenses and guild configs from Firestore after connection."""
-    global GUILD_CACHE
+    """Caches guild and member names after connection."""
+    global GUILD_CACHE, USER_CACHE_DIRTY
     print(f'Logged in as {bot.user} (ID: {bot.user.id})')
-    await load_licenses_from_firestore()
-    # FIX #1: Load guild configs (premium status) from Firestore so premium
-    # survives bot restarts on Hugging Face Spaces.
-    await load_guild_configs_from_firestore()
-    
+
     # Populate guild cache from bot's current guilds
     for guild in bot.guilds:
         GUILD_CACHE[guild.id] = guild.name
     save_data('guild_cache')
     print(f'Cached {len(GUILD_CACHE)} guild names.')
-    
+
+    # The members intent means every guild's member list is already here, so user names
+    # can be cached up front instead of being fetched one by one later.
+    for guild in bot.guilds:
+        for member in guild.members:
+            USER_CACHE[member.id] = member.global_name if member.global_name else member.name
+            # Names loaded from user_cache.json keep their old position otherwise, and would be evicted first.
+            USER_CACHE.move_to_end(member.id)
+    trim_user_cache()
+    USER_CACHE_DIRTY = True
+    print(f'Cached {len(USER_CACHE)} user names.')
+
     print('Bot is ready to accept commands.')
 
 
@@ -445,40 +788,40 @@ async def on_guild_join(guild: discord.Guild):
     print(f"Joined new guild: {guild.name} (ID: {guild.id})")
 
 
+async def on_automod_rule_change(rule: discord.AutoModRule):
+    """Drops the guild's cached AutoMod rules when one is created, updated or deleted."""
+    AUTOMOD_RULE_CACHE.pop(rule.guild.id, None)
+
+
+for event_name in ('on_automod_rule_create', 'on_automod_rule_update', 'on_automod_rule_delete'):
+    bot.add_listener(on_automod_rule_change, event_name)
+
+
+async def send_error_message(interaction: discord.Interaction, message: str):
+    """Sends an ephemeral error reply, as a followup if the interaction was already answered."""
+    if not interaction.response.is_done():
+        await interaction.response.send_message(message, ephemeral=True)
+    else:
+        await interaction.followup.send(message, ephemeral=True)
+
+
 @bot.tree.error
 async def on_app_command_error(interaction: discord.Interaction, error: Exception):
     print(f"DEBUG: App command error occurred - Type: {type(error).__name__}, Error: {error}")
-    import traceback
-    traceback.print_exc()
-    
+    traceback.print_exception(error)
+
     if isinstance(error, commands.MissingPermissions):
-        if not interaction.response.is_done():
-            await interaction.response.send_message(
-                f"<:x_mark:1503628893318414447> You do not have the required permission to use this command: `{error.missing_permissions[0]}`",
-                ephemeral=True
-            )
-        else:
-            await interaction.followup.send(f" <:x_mark:1503628893318414447> You do not have the required permission to use this command: `{error.missing_permissions[0]}`", ephemeral=True)
+        await send_error_message(interaction, f"<:x_mark:1503628893318414447> You do not have the required permission to use this command: `{error.missing_permissions[0]}`")
     elif isinstance(error, commands.MissingRequiredArgument):
-        if not interaction.response.is_done():
-            await interaction.response.send_message(
-                f"<:warn:1503628892378894446> Missing argument. Usage: `/{interaction.command.name} {interaction.command.usage}`",
-                ephemeral=True
-            )
-        else:
-            await interaction.followup.send(f"<:warn:1503628892378894446> Missing argument. Usage: `/{interaction.command.name} {interaction.command.usage}`", ephemeral=True)
+        await send_error_message(interaction, f"<:warn:1503628892378894446> Missing argument. Usage: `/{interaction.command.name} {interaction.command.usage}`")
     elif isinstance(error, app_commands.errors.CommandInvokeError) and isinstance(error.original, discord.errors.NotFound):
         print(f"Error handler avoided 'Unknown interaction' failure. Original command error was: {error.original}")
     elif isinstance(error, app_commands.CheckFailure):
         print(f"Check failed: {error}")
-        if not interaction.response.is_done():
-            await interaction.response.send_message("<:x_mark:1503628893318414447> You do not have permission to use this command.", ephemeral=True)
-        else:
-            await interaction.followup.send("<:x_mark:1503628893318414447> You do not have permission to use this command.", ephemeral=True)
+        await send_error_message(interaction, "<:x_mark:1503628893318414447> You do not have permission to use this command.")
     else:
         print(f"An unexpected error occurred: {error}")
-        if not interaction.response.is_done():
-            await interaction.response.send_message("<:warn:1503628892378894446> An unexpected error occurred while executing the command.", ephemeral=True)
+        await send_error_message(interaction, "<:warn:1503628892378894446> An unexpected error occurred while executing the command.")
 
 
 # ==============================================================================
@@ -488,47 +831,67 @@ async def on_app_command_error(interaction: discord.Interaction, error: Exceptio
 class LevelingCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.xp_cooldowns = {}  # {user_id: time.monotonic() value until which messages earn no XP}
+        self.prune_xp_cooldowns.start()
+
+    def cog_unload(self):
+        self.prune_xp_cooldowns.cancel()
 
     @commands.Cog.listener()
     async def on_message(self, message):
         if message.author.bot:
             return
 
-        user_id = str(message.author.id)
-        if user_id not in LEVELS_DB:
-            LEVELS_DB[user_id] = {'xp': 0, 'level': 0}
+        user_id = message.author.id
+        now = time.monotonic()
+        if self.xp_cooldowns.get(user_id, 0.0) <= now:
+            self.xp_cooldowns[user_id] = now + XP_COOLDOWN
+            data = LEVELS_DB.get(user_id)
+            if data is None:
+                data = LEVELS_DB[user_id] = UserLevel()
 
-        LEVELS_DB[user_id]['xp'] += random.randint(15, 25)
-        required_xp = (LEVELS_DB[user_id]['level'] + 1) * 100
-
-        if LEVELS_DB[user_id]['xp'] >= required_xp:
-            LEVELS_DB[user_id]['level'] += 1
-            LEVELS_DB[user_id]['xp'] = 0
-            save_data('levels')
+            data.xp += random.randrange(15, 26)
+            if data.xp >= (data.level + 1) * 100:
+                data.level += 1
+                data.xp = 0
+            append_levels_delta(user_id, data)
 
         await self.bot.process_commands(message)
 
+    @tasks.loop(minutes=10)
+    async def prune_xp_cooldowns(self):
+        """Drops expired cooldowns so xp_cooldowns only holds recently active users."""
+        now = time.monotonic()
+        self.xp_cooldowns = {user_id: until for user_id, until in self.xp_cooldowns.items() if until > now}
+
     @app_commands.command(name="rank", description="Shows a user's current level and XP.")
     async def rank_command(self, interaction: discord.Interaction, user: discord.Member = None):
         user = user or interaction.user
-        user_id_str = str(user.id)
-        data = LEVELS_DB.get(user_id_str, {'xp': 0, 'level': 0})
+        data = LEVELS_DB.get(user.id) or UserLevel()
         embed = discord.Embed(
             title=f"Level Rank for {user.display_name}",
             color=discord.Color.blue()
         )
-        embed.add_field(name="Level", value=data['level'], inline=True)
-        embed.add_field(name="XP", value=data['xp'], inline=True)
+        embed.add_field(name="Level", value=data.level, inline=True)
+        embed.add_field(name="XP", value=data.xp, inline=True)
         await interaction.response.send_message(embed=embed)
 
 
 class GiveawayCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.check_giveaways.start()
+        # (end_time, message_id) for every active giveaway, earliest first.
+        self.pending = [(data['end_time'], message_id) for message_id, data in ACTIVE_GIVEWAYS.items()]
+        heapq.heapify(self.pending)
+        self.giveaway_added = asyncio.Event()
+        self.giveaway_runner = None
 
-    def cog_unload(self):
-        self.check_giveaways.cancel()
+    async def cog_load(self):
+        self.giveaway_runner = asyncio.create_task(self.run_giveaways())
+
+    async def cog_unload(self):
+        if self.giveaway_runner is not None:
+            self.giveaway_runner.cancel()
 
     @app_commands.command(name="giveaway_start", description="Starts a new giveaway.")
     @app_commands.checks.has_permissions(manage_guild=True)
@@ -555,45 +918,72 @@ class GiveawayCog(commands.Cog):
             'host_id': interaction.user.id
         }
         save_data('giveaways')
+        heapq.heappush(self.pending, (end_time, giveaway_message.id))
+        # Wake run_giveaways in case this giveaway ends before the one it is waiting for.
+        self.giveaway_added.set()
+
+    async def run_giveaways(self):
+        """Ends giveaways as they expire, sleeping until the earliest end time or a new giveaway."""
+        await self.bot.wait_until_ready()
+        while True:
+            while self.pending and self.pending[0][0] <= time.time():
+                _, message_id = heapq.heappop(self.pending)
+                data = ACTIVE_GIVEWAYS.pop(message_id, None)
+                if data is None:
+                    continue
+                save_data('giveaways')
+                try:
+                    await self.end_giveaway(message_id, data)
+                except Exception as e:
+                    print(f"ERROR: Failed to end giveaway {message_id}: {e}")
 
-    @tasks.loop(minutes=1)
-    async def check_giveaways(self):
-        current_time = time.time()
-        expired_giveaways = [mid for mid, data in ACTIVE_GIVEWAYS.items() if data['end_time'] <= current_time]
-
-        for message_id in expired_giveaways:
-            data = ACTIVE_GIVEWAYS.pop(message_id)
-            save_data('giveaways')
+            self.giveaway_added.clear()
+            timeout = self.pending[0][0] - time.time() if self.pending else None
+            try:
+                await asyncio.wait_for(self.giveaway_added.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def end_giveaway(self, message_id, data):
+        """Draws the winners of an expired giveaway and announces them in its channel."""
+        channel = self.bot.get_channel(data['channel_id'])
+        if not channel:
+            return
 
-            channel = self.bot.get_channel(data['channel_id'])
-            if not channel:
-                continue
+        try:
+            message = await channel.fetch_message(message_id)
+        except discord.NotFound:
+            return
 
-            try:
-                message = await channel.fetch_message(message_id)
-            except discord.NotFound:
-                continue
-
-            users = set()
-            reaction = discord.utils.get(message.reactions, emoji='🎉')
-            if reaction:
-                async for user in reaction.users():
-                    if not user.bot:
-                        users.add(user)
-
-            participants = list(users)
-            if not participants:
-                final_message = "<:warn:1503628892378894446> Giveaway ended! No one entered the giveaway."
-            else:
-                num_winners = min(data['winner_count'], len(participants))
-                winners = random.sample(participants, num_winners)
-                winner_mentions = ", ".join([w.mention for w in winners])
-                final_message = (
-                    f"🎉 **GIVEAWAY ENDED!** 🎉\n"
-                    f"Prize: **{data['prize']}**\n"
-                    f"Winners ({num_winners}): {winner_mentions}!"
-                )
-            await channel.send(final_message, reference=message)
+        # Reservoir-sample the winners while paging through reactions instead of
+        # materialising every entrant; each entrant is equally likely to win.
+        winners = []
+        entrants = 0
+        reaction = next((r for r in message.reactions if r.emoji == '🎉'), None)
+        if reaction:
+            async for user in reaction.users():
+                if user.bot:
+                    continue
+                entrants += 1
+                if len(winners) < data['winner_count']:
+                    winners.append(user)
+                else:
+                    slot = random.randrange(entrants)
+                    if slot < len(winners):
+                        winners[slot] = user
+
+        if not entrants:
+            final_message = "<:warn:1503628892378894446> Giveaway ended! No one entered the giveaway."
+        else:
+            random.shuffle(winners)
+            num_winners = len(winners)
+            winner_mentions = ", ".join([w.mention for w in winners])
+            final_message = (
+                f"🎉 **GIVEAWAY ENDED!** 🎉\n"
+                f"Prize: **{data['prize']}**\n"
+                f"Winners ({num_winners}): {winner_mentions}!"
+            )
+        await channel.send(final_message, reference=message)
 
 
 def is_owner():
@@ -602,15 +992,36 @@ def is_owner():
     return app_commands.check(predicate)
 
 
+class BoundedStringIO(io.StringIO):
+    """A StringIO that stops growing at `limit` characters and drops the rest, setting `truncated`.
+
+    It never raises: redirect_stdout swaps sys.stdout for the whole process, so an error here
+    would hit print() calls from other tasks and threads, not just the /eval snippet.
+    """
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+        self.truncated = False
+
+    def write(self, s):
+        room = self.limit - self.tell()
+        if len(s) > room:
+            self.truncated = True
+            if room > 0:
+                super().write(s[:room])
+            return len(s)
+        return super().write(s)
+
+
 class UtilityCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.eval_cache = OrderedDict()  # Compiled /eval snippets keyed by source, least recently used first
 
     @app_commands.command(name="eval", description="<:crown:1503629761686274169> Executes Python code (Bot owner only).")
     @is_owner()
     async def eval_command(self, interaction: discord.Interaction, code: str):
         await interaction.response.defer(thinking=True, ephemeral=True)
-        code_block = textwrap.indent(code, '    ')
         env = {
             'bot': self.bot,
             'interaction': interaction,
@@ -621,10 +1032,19 @@ class UtilityCog(commands.Cog):
             'discord': discord,
             'DB': DB,
         }
-        stdout = io.StringIO()
+        stdout = BoundedStringIO(EVAL_OUTPUT_LIMIT)
         try:
             with contextlib.redirect_stdout(stdout):
-                exec(f'async def func():\n{code_block}', env)
+                code_obj = self.eval_cache.get(code)
+                if code_obj is None:
+                    code_block = textwrap.indent(code, '    ')
+                    code_obj = compile(f'async def func():\n{code_block}', '<eval>', 'exec')
+                    self.eval_cache[code] = code_obj
+                    if len(self.eval_cache) > EVAL_CACHE_MAX_SIZE:
+                        self.eval_cache.popitem(last=False)
+                else:
+                    self.eval_cache.move_to_end(code)
+                exec(code_obj, env)
                 result = await env['func']()
             output = stdout.getvalue()
         except Exception as e:
@@ -636,6 +1056,8 @@ class UtilityCog(commands.Cog):
                 output = f'```py\n{output}```'
             else:
                 output = '```py\nExecuted successfully with no output.```'
+            if stdout.truncated:
+                output += f"\n<:warn:1503628892378894446> Output was cut off after {EVAL_OUTPUT_LIMIT} characters."
 
         await interaction.followup.send(f"**<:check:1503628891258884166> Evaluation Complete**:\n{output}", ephemeral=True)
 
@@ -666,20 +1088,14 @@ class UtilityCog(commands.Cog):
     @is_owner()
     async def set_status_command(self, interaction: discord.Interaction, activity_type: int, status_text: str):
         await interaction.response.defer(thinking=True, ephemeral=True)
-        activity_map = {
-            0: discord.ActivityType.playing,
-            3: discord.ActivityType.watching,
-            2: discord.ActivityType.listening,
-            5: discord.ActivityType.competing
-        }
         activity = discord.Activity(
-            type=activity_map.get(activity_type, discord.ActivityType.playing),
+            type=ACTIVITY_TYPES.get(activity_type, discord.ActivityType.playing),
             name=status_text
         )
         try:
             await self.bot.change_presence(activity=activity)
             await interaction.followup.send(
-                f"<:check:1503628891258884166> Bot status updated to **{activity_map[activity_type].name.title()} {status_text}**.",
+                f"<:check:1503628891258884166> Bot status updated to **{activity.type.name.title()} {status_text}**.",
                 ephemeral=True
             )
         except Exception as e:
@@ -719,14 +1135,15 @@ class LicenseCog(commands.Cog):
             )
             return
 
-        license_key = str(uuid.uuid4()).upper().replace('-', '')[:16]
+        license_key = secrets.token_hex(8).upper()
+        created_at = time.time()
 
         if lifetime:
             expires_at = "LIFETIME"
             duration_str = "**Lifetime**"
             expiry_display = "Never (Lifetime)"
         else:
-            expires_at = (datetime.now(timezone.utc) + timedelta(days=30 * months)).timestamp()
+            expires_at = created_at + (30 * 86400 * months)
             duration_str = f"**{months} month{'s' if months != 1 else ''}**"
             expiry_display = f"<t:{int(expires_at)}:F>"
 
@@ -734,16 +1151,16 @@ class LicenseCog(commands.Cog):
             'months': months if not lifetime else None,
             'lifetime': lifetime,
             'created_by': interaction.user.id,
-            'created_at': time.time(),
+            'created_at': created_at,
             'expires_at': expires_at,
             'is_used': False,
             'used_by_guild': None,
             'used_by_user': None
         }
 
-        success = save_license_to_firestore(license_key, license_data)
+        success = await asyncio.to_thread(save_license_to_firestore, license_key, license_data)
         if success:
-            LICENSE_DB[license_key] = license_data
+            cache_license(license_key, license_data)
             await interaction.followup.send(
                 f"<:check:1503628891258884166> License Key Generated for {duration_str}:\n"
                 f"```\n{license_key}```\n"
@@ -763,7 +1180,7 @@ class LicenseCog(commands.Cog):
             await interaction.followup.send("<:x_mark:1503628893318414447> **Database not connected**. Activation failed.", ephemeral=True)
             return
 
-        license_data = get_license_from_firestore(key)
+        license_data = await get_license(key)
         if not license_data:
             await interaction.followup.send("<:x_mark:1503628893318414447> **Invalid key**. The provided license key was not found.", ephemeral=True)
             return
@@ -782,51 +1199,70 @@ class LicenseCog(commands.Cog):
             await interaction.followup.send("<:x_mark:1503628893318414447> This key has **expired** and cannot be used.", ephemeral=True)
             return
 
-        # Mark license as used in Firestore
-        guild_id_str = str(interaction.guild_id)
+        guild_id = interaction.guild_id
         user_id = interaction.user.id
 
+        # Work on a copy so the cached license stays unused if the commit below fails.
+        license_data = dict(license_data)
         license_data['is_used'] = True
         license_data['used_by_guild'] = interaction.guild_id
         license_data['used_by_user'] = user_id
+        is_lifetime_key = license_data.get('lifetime', False) or license_data.get('expires_at') == "LIFETIME"
+
+        # Hold the lock from reading the current premium status to updating CONFIG_DB, so activations
+        # and removals on one guild see each other's result and no guild config flush lands in between.
+        # A concurrent activation of the same key is refused by the transaction instead.
+        async with GUILD_CONFIG_WRITE_LOCK:
+            # Calculate new expiry
+            is_premium, current_expires_ts = is_guild_premium(guild_id)
 
-        success = save_license_to_firestore(key, license_data)
-        if not success:
+            if is_lifetime_key:
+                new_expires_at = "LIFETIME"
+                time_str = "<:check:1503628891258884166> Premium is now **activated** with **Lifetime** access."
+            else:
+                months = license_data['months']
+                if is_premium and current_expires_ts not in (None, "LIFETIME"):
+                    start_time = current_expires_ts
+                    time_str = "The existing premium status has been **extended**."
+                else:
+                    start_time = time.time()
+                    time_str = "<:check:1503628891258884166> Premium is now **activated**."
+                new_expires_at = start_time + (30 * 86400 * months)
+
+            premium_info = {
+                'active': True,
+                'key': key,
+                'activated_by': user_id,
+                'expires_at': new_expires_at
+            }
+
+            # Mark the license as used and grant premium in one Firestore transaction, so neither can
+            # be saved without the other. FIX #1: this also makes premium survive restarts.
+            status = await asyncio.to_thread(save_license_activation_to_firestore, key, license_data, guild_id, premium_info)
+            if status == 'activated':
+                cache_license(key, license_data)
+                # Merge into the config as it is now: other fields may have changed while the commit was in flight.
+                guild_config = dict(CONFIG_DB.get(guild_id, {}))
+                guild_config['premium'] = premium_info
+                CONFIG_DB[guild_id] = guild_config
+                if guild_id in PENDING_GUILD_CONFIGS:
+                    # The queued copy still has the old premium status.
+                    PENDING_GUILD_CONFIGS[guild_id] = guild_config
+                PREMIUM_CACHE.pop(guild_id, None)
+                save_data('config')
+            elif status == 'used':
+                # Used or deleted elsewhere since it was cached; the next lookup must refetch it.
+                LICENSE_DB.pop(key, None)
+
+        if status == 'failed':
             await interaction.followup.send(
                 "<:x_mark:1503628893318414447> **Internal Error**: Failed to update the license status in the database. Try again later.",
                 ephemeral=True
             )
             return
-
-        # Calculate new expiry
-        is_premium, current_expires_ts = is_guild_premium(interaction.guild_id)
-        is_lifetime_key = license_data.get('lifetime', False) or license_data.get('expires_at') == "LIFETIME"
-
-        if is_lifetime_key:
-            new_expires_at = "LIFETIME"
-            time_str = "<:check:1503628891258884166> Premium is now **activated** with **Lifetime** access."
-        else:
-            months = license_data['months']
-            if is_premium and current_expires_ts not in (None, "LIFETIME"):
-                start_time = current_expires_ts
-                time_str = "The existing premium status has been **extended**."
-            else:
-                start_time = time.time()
-                time_str = "<:check:1503628891258884166> Premium is now **activated**."
-            new_expires_at = start_time + (30 * 86400 * months)
-
-        # Update CONFIG_DB and save to both local file AND Firestore
-        guild_config = CONFIG_DB.get(guild_id_str, {})
-        guild_config['premium'] = {
-            'active': True,
-            'key': key,
-            'activated_by': user_id,
-            'expires_at': new_expires_at
-        }
-        CONFIG_DB[guild_id_str] = guild_config
-        save_data('config')
-        # FIX #1: Also persist to Firestore so premium survives restarts
-        save_guild_config_to_firestore(guild_id_str, guild_config)
+        if status == 'used':
+            await interaction.followup.send("<:x_mark:1503628893318414447> This key has already been **used** or no longer exists.", ephemeral=True)
+            return
 
         # Build success message
         if is_lifetime_key:
@@ -865,17 +1301,8 @@ class LicenseCog(commands.Cog):
         else:
             embed.description = "<:x_mark:1503628893318414447> **Standard Access**"
             embed.color = discord.Color.red()
-            guild_config = CONFIG_DB.get(str(interaction.guild_id), {})
-            premium_info = guild_config.get('premium', {})
-            raw_expires = premium_info.get('expires_at') if premium_info else None
-            if raw_expires and raw_expires != "LIFETIME":
-                try:
-                    if float(raw_expires) < time.time():
-                        embed.set_footer(text="Premium was active but has expired.")
-                    else:
-                        embed.set_footer(text="To activate premium, use the /license_activate command.")
-                except (TypeError, ValueError):
-                    embed.set_footer(text="To activate premium, use the /license_activate command.")
+            if expires_ts and expires_ts != "LIFETIME" and expires_ts < time.time():
+                embed.set_footer(text="Premium was active but has expired.")
             else:
                 embed.set_footer(text="To activate premium, use the /license_activate command.")
 
@@ -891,13 +1318,14 @@ class LicenseCog(commands.Cog):
             await interaction.followup.send("<:x_mark:1503628893318414447> **Database not connected**. Deletion failed.", ephemeral=True)
             return
 
-        license_data = get_license_from_firestore(key)
+        license_data = await get_license(key)
         if not license_data:
             await interaction.followup.send(f"<:x_mark:1503628893318414447> Key `{key}` was **not found** in the database.", ephemeral=True)
             return
 
-        success = delete_license_from_firestore(key)
+        success = await asyncio.to_thread(delete_license_from_firestore, key)
         if success:
+            LICENSE_DB.pop(key, None)
             await interaction.followup.send(f"<:check:1503628891258884166> Successfully **deleted** license key: `{key}`.", ephemeral=True)
         else:
             await interaction.followup.send(f"<:x_mark:1503628893318414447> **Error**: Failed to delete key `{key}` from the database.", ephemeral=True)
@@ -906,9 +1334,23 @@ class LicenseCog(commands.Cog):
     @app_commands.checks.has_permissions(administrator=True)
     async def subscription_remove_command(self, interaction: discord.Interaction):
         await interaction.response.defer(thinking=True, ephemeral=True)
-        guild_id_str = str(interaction.guild_id)
+        guild_id = interaction.guild_id
+
+        # Wait for any /license_activate on this guild to finish, so its grant is not removed half-applied.
+        async with GUILD_CONFIG_WRITE_LOCK:
+            is_premium, _ = is_guild_premium(guild_id)
+            if is_premium:
+                guild_config = CONFIG_DB.get(guild_id, {})
+                guild_config['premium'] = {
+                    'active': False,
+                    'expires_at': time.time() - 1
+                }
+                CONFIG_DB[guild_id] = guild_config
+                PREMIUM_CACHE.pop(guild_id, None)
+                save_data('config')
+                # FIX #1: Also update Firestore so the removal persists after restarts
+                save_guild_config_to_firestore(guild_id, guild_config)
 
-        is_premium, _ = is_guild_premium(interaction.guild_id)
         if not is_premium:
             await interaction.followup.send(
                 "<:warn:1503628892378894446> This server currently does **__not__** have an active premium subscription to remove.",
@@ -916,16 +1358,6 @@ class LicenseCog(commands.Cog):
             )
             return
 
-        guild_config = CONFIG_DB.get(guild_id_str, {})
-        guild_config['premium'] = {
-            'active': False,
-            'expires_at': time.time() - 1
-        }
-        CONFIG_DB[guild_id_str] = guild_config
-        save_data('config')
-        # FIX #1: Also update Firestore so the removal persists after restarts
-        save_guild_config_to_firestore(guild_id_str, guild_config)
-
         await interaction.followup.send(
             "<:check:1503628891258884166> Premium subscription has been immediately **__removed__** from this server. Access has been reverted to standard.",
             ephemeral=False
@@ -1021,6 +1453,9 @@ class AutoModCog(commands.Cog):
                 )
                 message = f"🎉 **{self.RULE_NAME}** rule created successfully! It blocks **{len(word_list)}** words."
 
+            # Don't wait for the gateway event: until it arrives the cache still holds the old rules,
+            # and another /automod_setup in that window would create a duplicate rule.
+            AUTOMOD_RULE_CACHE.pop(interaction.guild.id, None)
             await interaction.followup.send(message, ephemeral=False)
 
         except discord.Forbidden:
@@ -1038,6 +1473,4 @@ class AutoModCog(commands.Cog):
 # ==============================================================================
 
 if __name__ == "__main__":
-    keep_alive()
-    initialize_firestore()
     bot.run(os.environ.get('DISCORD_TOKEN'))
\ No newline at end of file
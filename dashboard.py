@@ -1,5 +1,6 @@
 import os
 import json
+import orjson
 import time
 from datetime import datetime, timezone, timedelta
 from functools import wraps
@@ -9,6 +10,7 @@ from flask_session import Session
 import firebase_admin
 from firebase_admin import credentials, firestore
 import uuid
+import secrets
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -226,7 +228,7 @@ def generate_license(months=0, lifetime=False):
     if not lifetime and months <= 0:
         return None
     
-    license_key = str(uuid.uuid4()).upper().replace('-', '')[:16]
+    license_key = secrets.token_hex(8).upper()
     
     if lifetime:
         expires_at = "LIFETIME"
@@ -1345,7 +1347,7 @@ def dashboard():
     guilds = user.get('guilds', [])
     is_owner = int(user['id']) == BOT_OWNER_ID
     
-    guild_cards = ""
+    card_parts = []
     for guild in guilds:
         guild_id = guild['id']
         guild_name = guild['name']
@@ -1360,7 +1362,7 @@ def dashboard():
             icon_html = f'<span>{guild_name[0].upper()}</span>'
         
         if admin or (guild.get('permissions') & 0x8):
-            guild_cards += f"""
+            card_parts.append(f"""
             <a href="{url_for('guild_settings', guild_id=guild_id)}" class="guild-card">
                 <div class="guild-avatar">
                     {icon_html}
@@ -1371,7 +1373,8 @@ def dashboard():
                 </div>
                 <div class="guild-arrow">→</div>
             </a>
-            """
+            """)
+    guild_cards = "".join(card_parts)
     
     owner_section = ""
     if is_owner:
@@ -1486,7 +1489,7 @@ def owner_panel():
     user = get_discord_user()
     active_giveaways = get_active_giveaways()
     
-    giveaway_rows = ""
+    row_parts = []
     for ga in active_giveaways:
         prize = ga.get('prize', 'Unknown')
         winners = ga.get('winner_count', 1)
@@ -1496,14 +1499,15 @@ def owner_panel():
         hours_left = int(time_left / 3600)
         minutes_left = int((time_left % 3600) / 60)
         
-        giveaway_rows += f"""
+        row_parts.append(f"""
         <tr>
             <td>{prize}</td>
             <td>{winners}</td>
             <td>{entries}</td>
             <td>{hours_left}h {minutes_left}m</td>
         </tr>
-        """
+        """)
+    giveaway_rows = "".join(row_parts)
     
     if not giveaway_rows:
         giveaway_rows = "<tr><td colspan='4' style='text-align: center; color: #99aab5;'>No active giveaways</td></tr>"
@@ -2371,8 +2375,8 @@ def load_guild_cache():
     guild_cache = {}
     try:
         if os.path.exists('guild_cache.json'):
-            with open('guild_cache.json', 'r') as f:
-                guild_cache = {int(k): v for k, v in json.load(f).items()}
+            with open('guild_cache.json', 'rb') as f:
+                guild_cache = {int(k): v for k, v in orjson.loads(f.read()).items()}
     except Exception as e:
         print(f"Error loading guild cache: {e}")
     return guild_cache
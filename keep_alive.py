@@ -1,21 +1,21 @@
-from flask import Flask
-from threading import Thread
+from aiohttp import web
 
-app = Flask('')
+async def home(request):
+    return web.Response(text="Spectra Bot is alive!")
 
-@app.route('/')
-def home():
-    return "Spectra Bot is alive!"
+def make_app():
+    app = web.Application()
+    app.router.add_get('/', home)
+    return app
 
-def run():
-    # Only the Flask server runs here
-    app.run(host='0.0.0.0', port=8080)
+async def keep_alive(host='0.0.0.0', port=8080):
+    # Serves the ping endpoint on the caller's event loop instead of a separate server thread.
+    # The returned runner must be cleaned up on shutdown.
+    runner = web.AppRunner(make_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
 
-def keep_alive():
-    # This starts the run function in a non-blocking thread
-    t = Thread(target=run)
-    t.start()
-    
 if __name__ == '__main__':
-    # This block prevents the thread from being created if run() is called directly
-    run()
\ No newline at end of file
+    # Running this file directly serves the endpoint on its own
+    web.run_app(make_app(), host='0.0.0.0', port=8080)